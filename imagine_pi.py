@@ -4,20 +4,33 @@
 ###########
 ## Stdlib
 
+import argparse
+import bisect
+import difflib
+import fnmatch
 import gzip
 import hashlib
 import itertools
 import json
 import lzma
+import mmap
 import os
+import random
+import queue
 import re
 import shlex
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import uuid
 import zipfile
 from collections import namedtuple
 from curses import wrapper
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse
 
 import requests
@@ -29,6 +42,7 @@ __version__ = '0.3.dev'
 PY3 = sys.version_info[0] == 3
 string_types = str if PY3 else basestring # pylint: disable=undefined-variable
 Response = namedtuple('Response', 'returncode value')
+ProbeRegion = namedtuple('ProbeRegion', 'offset size sequential latency')
 
 ENV = 'prd'
 
@@ -41,6 +55,67 @@ CACHE_IMAGE_PATH = CACHE_PATH + '/images'
 WHIPTAIL_HEIGHT = 20
 WHIPTAIL_WIDTH = 80
 
+# prefetch: fnmatch patterns on os names, bytes/sec (0 = unlimited)
+# and 'HH:MM-HH:MM' windows during which downloads may run
+PREFETCH_ALLOW = []
+PREFETCH_BANDWIDTH = 0
+PREFETCH_WINDOWS = []
+
+# peer cache: 'host:port' peers to ask before the upstream url and the
+# multicast group used to discover peers serving their cache on the LAN
+PEERS = []
+PEER_PORT = 8442
+PEER_TIMEOUT = 2
+PEER_MULTICAST_GROUP = ('239.255.42.99', 8443)
+PEER_DISCOVERY_QUERY = b'IMAGINE-PI?'
+PEER_DISCOVERY_REPLY = 'IMAGINE-PI'
+
+# mirrors: base urls serving the same paths as the upstream download url,
+# probed at open and switched to from the current offset when a stream
+# stays below MIRROR_STALL_RATE bytes/sec for MIRROR_STALL_SECONDS
+MIRRORS = []
+MIRROR_PROBE_BYTES = 256 * 1024
+MIRROR_STALL_RATE = 64 * 1024
+MIRROR_STALL_SECONDS = 10
+MIRROR_MAX_FAILOVERS = 10
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+
+# probe: sampled blocks checked for fake capacity and regions profiled for
+# sequential throughput and random write latency before writing an image
+PROBE_REGIONS = 16
+PROBE_SAMPLES = 64
+PROBE_BLOCK_SIZE = 4096
+PROBE_SEQ_BYTES = 4 * 1024 * 1024
+PROBE_SEQ_BLOCK = 1024 * 1024
+PROBE_RANDOM_WRITES = 8
+PROBE_MIN_THROUGHPUT = 0
+
+# catalog search: field weights when ranking matches and the similarity a
+# token needs for a fuzzy match when a term has no prefix match
+SEARCH_WEIGHTS = {'name': 3, 'devices': 2, 'description': 1, 'release_date': 1, 'sha': 1}
+SEARCH_FUZZY_CUTOFF = 0.75
+SEARCH_MAX_RESULTS = 50
+
+# boot customization: the boot partition is held in a spooled buffer while
+# patched, in memory up to BOOT_SPOOL_SIZE bytes and on disk beyond that
+SECTOR_SIZE = 512
+BOOT_SPOOL_SIZE = 64 * 1024 * 1024
+FAT_PARTITION_TYPES = (0x01, 0x04, 0x06, 0x0b, 0x0c, 0x0e)
+FIRSTRUN_PATH = '/boot/firstrun.sh'
+FIRSTRUN_CMDLINE = ' systemd.run={0} systemd.run_success_action=reboot systemd.unit=kernel-command-line.target'
+WIFI_COUNTRY = 'GB'
+
+# batch: each bus starts with one writer and gains another while that
+# raises its measured throughput by at least BATCH_MIN_GAIN
+BATCH_BLOCK_SIZE = 1024 * 1024
+BATCH_QUEUE_BLOCKS = 16
+BATCH_SYNC_BYTES = 64 * 1024 * 1024
+BATCH_SAMPLE_INTERVAL = 1
+BATCH_SETTLE_SAMPLES = 5
+BATCH_MAX_PER_BUS = 8
+BATCH_MIN_GAIN = 0.1
+
 ####################
 ## Strings
 
@@ -67,6 +142,83 @@ STR_RETRIEVING = 'retrieving {0}'
 STR_WRITING_IMG = 'writing {0} to {1}'
 STR_IMG_INSTALLED = 'image {0} installed on {1}'
 STR_SUCCESS = 'success!'
+STR_PREFETCH_PENDING = '{0} image(s) to prefetch'
+STR_PREFETCH_WAITING = 'waiting for prefetch window {0}'
+STR_PREFETCHING = 'prefetching {0}'
+STR_PREFETCHED = '{0} prefetched'
+STR_PREFETCH_FAILED = 'prefetching {0} failed: {1}'
+STR_PREFETCH_UNVERIFIABLE = '{0} has no image sha256, not prefetchable'
+STR_PEERS = 'peer cache'
+STR_SERVING = 'serving cache on port {0}'
+STR_CUSTOMIZING = 'customizing boot partition: {0}'
+STR_BATCH_JOB = '{0} -> {1} [{2}]'
+STR_CONFIRM_BATCH = 'Install {0} job(s)\n{1}'
+STR_BATCH_DONE = '{0} job(s) written, {1} failed in {2} @ {3}/sec'
+STR_BATCH_FAILED = 'writing {0} to {1} failed: {2}'
+STR_BATCH_INVALID = 'invalid batch line {0}: {1}'
+STR_PROBING = 'probing {0}'
+STR_PROBE_FAKE = '{0} failed the capacity check, {1} of {2} sampled blocks lost their data'
+STR_PROBE_ERROR = '{0} failed the probe: {1}'
+STR_PROBE_SLOW = '{0} writes at {1}/sec, below the {2}/sec floor'
+STR_PROBE_ESTIMATE = 'estimated time to write {0}: {1}'
+STR_PROBE_PASSED = '{0} passed probe'
+STR_SEARCH_RESULTS = '{0} match(es) for "{1}"'
+STR_SEARCH_NO_RESULTS = 'No OS matches "{0}"'
+STR_SEARCH_RESULT = ' - {0} ({1}, {2}) [{3}]'
+
+FIRSTRUN_TEMPLATE = '''#!/bin/bash
+set +e
+{0}
+rm -f /boot/firstrun.sh /boot/firmware/firstrun.sh
+sed -i 's| systemd.run.*||g' /boot/cmdline.txt /boot/firmware/cmdline.txt 2>/dev/null
+exit 0
+'''
+FIRSTRUN_HOSTNAME = '''CURRENT_HOSTNAME=$(tr -d " \\t\\n\\r" < /etc/hostname)
+echo {0} > /etc/hostname
+sed -i "s/127.0.1.1.*$CURRENT_HOSTNAME/127.0.1.1\\t{0}/g" /etc/hosts'''
+WPA_SUPPLICANT_TEMPLATE = '''ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
+country={0}
+update_config=1
+
+network={{
+\tssid={1}
+\t{2}
+}}
+'''
+NM_CONNECTION_TEMPLATE = '''[connection]
+id=preconfigured
+uuid={0}
+type=wifi
+
+[wifi]
+mode=infrastructure
+ssid={1}
+{2}
+[ipv4]
+method=auto
+
+[ipv6]
+addr-gen-mode=default
+method=auto
+'''
+NM_WIFI_SECURITY = '''
+[wifi-security]
+key-mgmt=wpa-psk
+psk={0}
+'''
+FIRSTRUN_WIFI = '''if [ -d /etc/NetworkManager/system-connections ]; then
+   cat >/etc/NetworkManager/system-connections/preconfigured.nmconnection <<'WIFIEOF'
+{0}WIFIEOF
+   chmod 600 /etc/NetworkManager/system-connections/preconfigured.nmconnection
+else
+   cat >/etc/wpa_supplicant/wpa_supplicant.conf <<'WIFIEOF'
+{1}WIFIEOF
+   chmod 600 /etc/wpa_supplicant/wpa_supplicant.conf
+fi
+rfkill unblock wifi
+for filename in /var/lib/systemd/rfkill/*:wlan ; do
+   echo 0 > $filename
+done'''
 
 STR_BACKTITLE = '{0} - {1}'.format(STR_TITLE, STR_TITLE_SUB)
 STR_HR = '-' * max(50, (len(STR_BACKTITLE) + 4))
@@ -155,7 +307,7 @@ class Output(HumanReadable):
 
         # This is the most portable way (across POSIX systems) to get
         # our screen size that I can find, so, screw windows. Yeah.
-        if ENV == 'dev':
+        if ENV == 'dev' or not sys.stderr.isatty():
             self.max_x = 80
             self.max_y = 40
         else:
@@ -287,26 +439,84 @@ class Whiptail(object):
         return self.showlist('checklist', msg, items, prefix)
 
     def submenu(self, msg='', items=(), name_property='name', subitems_property='subitems'):
-        item_names = []
-        for i, v in enumerate(items):
-            item_name = '[' + str(i) + ']' + v[name_property]
-            if subitems_property in v:
-                item_name += " >>"
-            item_names.append(item_name)
-
-        choice = self.menu(msg, item_names)
+        while True:
+            item_names = []
+            for i, v in enumerate(items):
+                item_name = '[' + str(i) + ']' + v[name_property]
+                if subitems_property in v:
+                    item_name += " >>"
+                item_names.append(item_name)
+
+            item = self._choose(self.menu(msg, item_names), items)
+            if item is None or subitems_property not in item:
+                return item
+            items = item[subitems_property]
+
+    def filtermenu(self, msg='', items=(), name_property='name', description_property='description'):
+        """pick one of a flat list of items on a single screen"""
+        choices = [
+            ('[' + str(i) + ']' + v[name_property], v.get(description_property, ''))
+            for i, v in enumerate(items)
+        ]
+        return self._choose(self.menu(msg, choices), items)
+
+    def _choose(self, choice, items):
         choice = choice.decode('utf-8')
         choice_digit = re.search(r"^\[(\d+)\]", str(choice))
         if not choice_digit:
             print('Not a valid submenu:')
+            return None
+        return items[int(choice_digit[1])]
+
+class TokenBucket(object):
+    """limit throughput to rate bytes per second with bursts up to capacity"""
+    def __init__(self, rate=0, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+
+    def consume(self, amount):
+        if not self.rate:
             return
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+        self._tokens -= amount
+        # reads larger than the bucket go into debt and are paid back here
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+class TimeWindows(object):
+    """daily 'HH:MM-HH:MM' windows, windows may wrap past midnight"""
+    def __init__(self, windows=()):
+        self.windows = [self._parse(w) for w in windows]
+
+    def _parse(self, window):
+        match = re.match(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$", window.strip())
+        if not match:
+            raise ValueError('invalid time window: {0}'.format(window))
+        start_h, start_m, end_h, end_m = [int(g) for g in match.groups()]
+        return (start_h * 60 + start_m, end_h * 60 + end_m)
+
+    def is_open(self, now=None):
+        if not self.windows:
+            return True
+        now = now or time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return True
+            if start > end and (minute >= start or minute < end):
+                return True
+        return False
 
-        item = items[int(choice_digit[1])]
-
-        if subitems_property in item:
-            return self.submenu(msg, item[subitems_property], name_property, subitems_property)
-
-        return item
+    def wait(self, poll=30):
+        while not self.is_open():
+            time.sleep(poll)
 
 ################
 ## I/O classes
@@ -390,16 +600,111 @@ class FileIo(Io):
         return False
 
 class HttpIo(Io):
-    """use http as source for transfer"""
-    def __init__(self, target_path=None):
+    """use http as source for transfer, asking peers for sha256 before the url"""
+    def __init__(self, target_path=None, sha256=None, peers=()):
         super().__init__(target_path)
-        self.response  = None
+        self._response = None
+        self._sha256 = sha256
+        self._peers = peers if sha256 else ()
+        self._mirrors = []
+        self._offset = 0
+        self._failovers = 0
+        self._window_time = 0
+        self._window_bytes = 0
+        self._slow_seconds = 0
+        self.peer = None
+        self.url = None
 
     def open(self):
-        self._response = requests.get(self._target_path, stream=True)
+        for peer in self._peers:
+            url = 'http://{0}/sha256/{1}'.format(peer, self._sha256)
+            try:
+                response = requests.get(url, stream=True, timeout=PEER_TIMEOUT)
+            except requests.RequestException:
+                continue
+            if response.status_code == 200:
+                self._response = response
+                self.peer = peer
+                break
+            response.close()
+
+        if not self._response:
+            if not self._target_path:
+                raise FileNotFoundError(self._sha256)
+            self._mirrors = probe_mirrors(mirror_urls(self._target_path))
+            self._connect()
         self.target = self._response.raw
         self.size = int(self._response.headers.get('content-length'))
 
+    def _connect(self):
+        headers = {'Range': 'bytes={0}-'.format(self._offset)} if self._offset else {}
+        while self._mirrors:
+            url = self._mirrors[0]
+            try:
+                response = requests.get(
+                    url,
+                    stream=True,
+                    headers=headers,
+                    timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+                )
+                if response.status_code == (206 if self._offset else 200):
+                    self._response = response
+                    self.target = response.raw
+                    self.url = url
+                    return
+                response.close()
+            except requests.RequestException:
+                pass
+            self._mirrors.pop(0)
+        raise ConnectionError('no mirror available for {0}'.format(self._target_path))
+
+    def _failover(self):
+        self._failovers += 1
+        if self._failovers > MIRROR_MAX_FAILOVERS:
+            raise ConnectionError('giving up on {0} after {1} failovers'.format(
+                self._target_path, MIRROR_MAX_FAILOVERS
+            ))
+        self._response.close()
+        self._response = None
+        # retry the current mirror last, it may only have had a hiccup
+        self._mirrors.append(self._mirrors.pop(0))
+        self._connect()
+        self._window_time = 0
+        self._window_bytes = 0
+        self._slow_seconds = 0
+
+    def read(self, bsize=40960):
+        if not self._mirrors:
+            return self.target.read(bsize)
+
+        while True:
+            try:
+                # read1 returns what has arrived instead of waiting to fill
+                # bsize, so a trickling mirror still shows up as stalled
+                read = getattr(self.target, 'read1', self.target.read)
+                st = time.monotonic()
+                buff = read(bsize)
+                break
+            except (OSError, requests.RequestException, requests.packages.urllib3.exceptions.HTTPError):
+                self._failover()
+
+        # only time spent waiting on the mirror counts, so bandwidth limits
+        # and time windows applied around read() never look like a stall
+        self._window_time += time.monotonic() - st
+        self._offset += len(buff)
+        self._window_bytes += len(buff)
+        if self._window_time >= 1:
+            if self._window_bytes / self._window_time < MIRROR_STALL_RATE:
+                self._slow_seconds += self._window_time
+            else:
+                self._slow_seconds = 0
+                self._failovers = 0
+            self._window_time = 0
+            self._window_bytes = 0
+        if buff and len(self._mirrors) > 1 and self._slow_seconds >= MIRROR_STALL_SECONDS:
+            self._failover()
+        return buff
+
     def close(self):
         if self._response:
             self._response.close()
@@ -456,7 +761,28 @@ class GZipFileIo(Io):
     def open(self):
         self.target = gzip.open(self._target_path, self._mode)
 
-def extract_img(src_path, dst_path, total_size):
+class ThrottledIo(Io):
+    """wrap a source IO and shape reads with a token bucket and time windows"""
+    def __init__(self, source, bucket=None, windows=None):
+        super().__init__(source._target_path)
+        self._source = source
+        self._bucket = bucket or TokenBucket()
+        self._windows = windows or TimeWindows()
+
+    def open(self):
+        self._source.open()
+        self.size = self._source.size
+
+    def close(self):
+        self._source.close()
+
+    def read(self, bsize=40960):
+        self._windows.wait()
+        buff = self._source.read(bsize)
+        self._bucket.consume(len(buff))
+        return buff
+
+def extract_img(src_path, dst_path, total_size, quiet=False):
     """extract file from archive"""
     archive_basename = os.path.basename(src_path)
     archive_ext = os.path.splitext(archive_basename)
@@ -469,8 +795,9 @@ def extract_img(src_path, dst_path, total_size):
         src = LZMAFileIo(src_path, 'rb', total_size)
     if archive_compression == '.gz':
         src = GZipFileIo(src_path, 'rb', total_size)
-    dst = FileIo(dst_path, 'wb')
-    Transfer(src, dst, prefix='').start()
+    # hash while extracting so the next cache check does not reread the image
+    dst = FileIo(dst_path, 'wb', withHash=True)
+    Transfer(src, dst, quiet=quiet, prefix='').start()
 
 ###################
 ## HashFile class
@@ -571,6 +898,291 @@ class HashFile(object):
                 return os.path.isfile(target_path)
         return False
 
+###################
+## Boot partition classes
+
+class FatFs(object):
+    """edit files in the root directory of a FAT16/FAT32 filesystem held in a seekable file"""
+    def __init__(self, f):
+        self._f = f
+        bpb = self._read(0, SECTOR_SIZE)
+        (self.bytes_per_sector, self.sectors_per_cluster, reserved, self.num_fats,
+         root_entries, total16, _, fat_size16) = struct.unpack_from('<HBHBHHBH', bpb, 11)
+        total32, fat_size32, self.root_cluster, fsinfo = struct.unpack_from('<IIxxxxIH', bpb, 32)
+        if not self.bytes_per_sector or not self.sectors_per_cluster:
+            raise ValueError('not a FAT filesystem')
+
+        self.fat_size = (fat_size16 or fat_size32) * self.bytes_per_sector
+        self.fat_offset = reserved * self.bytes_per_sector
+        self.root_offset = self.fat_offset + self.num_fats * self.fat_size
+        self.root_entries = root_entries
+        root_size = -(-root_entries * 32 // self.bytes_per_sector) * self.bytes_per_sector
+        self.data_offset = self.root_offset + root_size
+        self.cluster_size = self.sectors_per_cluster * self.bytes_per_sector
+        total_size = (total16 or total32) * self.bytes_per_sector
+        self.cluster_count = (total_size - self.data_offset) // self.cluster_size
+        if self.cluster_count < 4085:
+            raise ValueError('FAT12 is not supported')
+        self.fat_type = 16 if self.cluster_count < 65525 else 32
+        self.fsinfo_offset = fsinfo * self.bytes_per_sector if self.fat_type == 32 else None
+        self.eoc = 0xFFF8 if self.fat_type == 16 else 0x0FFFFFF8
+        self._fat = bytearray(self._read(self.fat_offset, self.fat_size))
+
+    def _read(self, offset, size):
+        self._f.seek(offset)
+        return self._f.read(size)
+
+    def _write(self, offset, data):
+        self._f.seek(offset)
+        self._f.write(data)
+
+    def _get(self, cluster):
+        if self.fat_type == 16:
+            return struct.unpack_from('<H', self._fat, cluster * 2)[0]
+        return struct.unpack_from('<I', self._fat, cluster * 4)[0] & 0x0FFFFFFF
+
+    def _set(self, cluster, value):
+        if self.fat_type == 16:
+            struct.pack_into('<H', self._fat, cluster * 2, value)
+        else:
+            high = struct.unpack_from('<I', self._fat, cluster * 4)[0] & 0xF0000000
+            struct.pack_into('<I', self._fat, cluster * 4, high | value)
+
+    def _chain(self, cluster):
+        chain = []
+        while 2 <= cluster < self.eoc and len(chain) <= self.cluster_count:
+            chain.append(cluster)
+            cluster = self._get(cluster)
+        return chain
+
+    def _cluster_offset(self, cluster):
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _allocate(self, count, after=None):
+        free = []
+        for cluster in range(2, self.cluster_count + 2):
+            if len(free) == count:
+                break
+            if self._get(cluster) == 0:
+                free.append(cluster)
+        if len(free) < count:
+            raise OSError('no free clusters left on boot partition')
+        for cluster, following in zip(free, free[1:] + [0x0FFFFFFF]):
+            self._set(cluster, following & (0xFFFF if self.fat_type == 16 else 0x0FFFFFFF))
+        if after and free:
+            self._set(after, free[0])
+        return free
+
+    def _dir_slots(self):
+        if self.fat_type == 16:
+            return [self.root_offset + i * 32 for i in range(self.root_entries)]
+        slots = []
+        for cluster in self._chain(self.root_cluster):
+            offset = self._cluster_offset(cluster)
+            slots += [offset + i for i in range(0, self.cluster_size, 32)]
+        return slots
+
+    def _entries(self):
+        """yield (name, short_name, entry_offset, slot_offsets) for root directory files"""
+        lfn, lfn_slots, lfn_checksum = [], [], None
+        for slot in self._dir_slots():
+            entry = self._read(slot, 32)
+            if entry[0] == 0x00:
+                return
+            if entry[0] == 0xE5:
+                lfn, lfn_slots = [], []
+                continue
+            if entry[11] == 0x0F:
+                if entry[0] & 0x40:
+                    lfn, lfn_slots, lfn_checksum = [], [], entry[13]
+                lfn.insert(0, entry[1:11] + entry[14:26] + entry[28:32])
+                lfn_slots.append(slot)
+                continue
+            if not entry[11] & 0x08:
+                short_name = entry[:11]
+                if lfn and lfn_checksum == fat_checksum(short_name):
+                    name = b''.join(lfn).decode('utf-16-le', 'replace').split('\x00')[0]
+                    yield name, short_name, slot, lfn_slots + [slot]
+                else:
+                    yield self._short_name(entry), short_name, slot, [slot]
+            lfn, lfn_slots = [], []
+
+    def _short_name(self, entry):
+        base = entry[:8].decode('ascii', 'replace').rstrip()
+        ext = entry[8:11].decode('ascii', 'replace').rstrip()
+        if entry[12] & 0x08:
+            base = base.lower()
+        if entry[12] & 0x10:
+            ext = ext.lower()
+        return base + ('.' + ext if ext else '')
+
+    def _find(self, name):
+        for entry_name, _, slot, slots in self._entries():
+            if entry_name.lower() == name.lower():
+                return slot, slots
+        return None, None
+
+    def read_file(self, name):
+        slot, _ = self._find(name)
+        if slot is None:
+            raise FileNotFoundError(name)
+        entry = self._read(slot, 32)
+        first = struct.unpack_from('<H', entry, 20)[0] << 16 | struct.unpack_from('<H', entry, 26)[0]
+        size = struct.unpack_from('<I', entry, 28)[0]
+        data = b''.join(
+            self._read(self._cluster_offset(c), self.cluster_size) for c in self._chain(first)
+        )
+        return data[:size]
+
+    def write_file(self, name, data):
+        if '/' in name or '\\' in name:
+            raise ValueError('only files in the boot partition root are supported: {0}'.format(name))
+        slot, _ = self._find(name)
+        if slot is None:
+            slot = self._create_entry(name)
+        else:
+            entry = self._read(slot, 32)
+            old = struct.unpack_from('<H', entry, 20)[0] << 16 | struct.unpack_from('<H', entry, 26)[0]
+            for cluster in self._chain(old):
+                self._set(cluster, 0)
+
+        clusters = self._allocate(-(-len(data) // self.cluster_size))
+        for i, cluster in enumerate(clusters):
+            chunk = data[i * self.cluster_size:(i + 1) * self.cluster_size]
+            self._write(self._cluster_offset(cluster), chunk.ljust(self.cluster_size, b'\x00'))
+
+        first = clusters[0] if clusters else 0
+        date, mtime = dos_datetime()
+        entry = bytearray(self._read(slot, 32))
+        struct.pack_into('<H', entry, 20, first >> 16)
+        struct.pack_into('<HHHI', entry, 22, mtime, date, first & 0xFFFF, len(data))
+        self._write(slot, bytes(entry))
+
+    def _create_entry(self, name):
+        short_names = [short for _, short, _, _ in self._entries()]
+        short_name, exact = fat_short_name(name, short_names)
+        lfn_count = 0 if exact else -(-len(name) // 13)
+
+        slots = self._free_slots(lfn_count + 1)
+        checksum = fat_checksum(short_name)
+        encoded = name.encode('utf-16-le') + b'\x00\x00'
+        encoded = encoded.ljust(lfn_count * 26, b'\xff')
+        for i in range(lfn_count):
+            seq = lfn_count - i
+            part = encoded[(seq - 1) * 26:seq * 26]
+            entry = bytes([seq | (0x40 if i == 0 else 0)]) + part[:10] + bytes([0x0F, 0, checksum]) \
+                + part[10:22] + b'\x00\x00' + part[22:26]
+            self._write(slots[i], entry)
+
+        date, mtime = dos_datetime()
+        entry = short_name + struct.pack('<BBBHHHHHHHI', 0x20, 0, 0, mtime, date, date, 0, mtime, date, 0, 0)
+        self._write(slots[-1], entry)
+        return slots[-1]
+
+    def _free_slots(self, count):
+        run = []
+        for slot in self._dir_slots():
+            first = self._read(slot, 1)
+            if first in (b'\x00', b'\xe5'):
+                run.append(slot)
+                if len(run) == count:
+                    return run
+            else:
+                run = []
+        if self.fat_type == 16:
+            raise OSError('boot partition root directory is full')
+
+        # extend the FAT32 root directory with a zeroed cluster
+        last = self._chain(self.root_cluster)[-1]
+        cluster = self._allocate(1, after=last)[0]
+        self._write(self._cluster_offset(cluster), b'\x00' * self.cluster_size)
+        return self._free_slots(count)
+
+    def flush(self):
+        for i in range(self.num_fats):
+            self._write(self.fat_offset + i * self.fat_size, bytes(self._fat))
+        if self.fsinfo_offset and self._read(self.fsinfo_offset, 4) == b'RRaA':
+            # free count and next free hint are advisory, mark them unknown
+            self._write(self.fsinfo_offset + 488, b'\xff' * 8)
+
+class BootCustomizeIo(Io):
+    """wrap an image source and patch files on its FAT boot partition while streaming"""
+    def __init__(self, source, files=None, bsize=BUF_SIZE):
+        super().__init__(source._target_path)
+        self._source = source
+        self._files = files or {}
+        self._bsize = bsize
+        self._chunks = None
+
+    def open(self):
+        self._source.open()
+        self.size = self._source.size
+        self._chunks = self._stream()
+
+    def close(self):
+        if self._chunks:
+            self._chunks.close()
+            self._chunks = None
+        self._source.close()
+
+    def read(self, bsize=40960):
+        self._bsize = bsize
+        return next(self._chunks, b'')
+
+    def _read_exact(self, size):
+        buff = b''
+        while len(buff) < size:
+            data = self._source.read(min(self._bsize, size - len(buff)))
+            if not data:
+                break
+            buff += data
+        return buff
+
+    def _stream(self):
+        head = self._read_exact(SECTOR_SIZE)
+        start, length = find_boot_partition(head)
+        yield head
+
+        remaining = start - len(head)
+        while remaining > 0:
+            buff = self._read_exact(min(self._bsize, remaining))
+            if not buff:
+                raise EOFError('image ends before its boot partition')
+            remaining -= len(buff)
+            yield buff
+
+        # hold back the boot partition until it is patched so the device
+        # still receives a single sequential write
+        with tempfile.SpooledTemporaryFile(max_size=BOOT_SPOOL_SIZE) as spool:
+            remaining = length
+            while remaining > 0:
+                buff = self._read_exact(min(self._bsize, remaining))
+                if not buff:
+                    raise EOFError('image ends inside its boot partition')
+                spool.write(buff)
+                remaining -= len(buff)
+
+            fs = FatFs(spool)
+            for name, content in self._files.items():
+                if callable(content):
+                    try:
+                        content = content(fs.read_file(name))
+                    except FileNotFoundError:
+                        content = content(b'')
+                fs.write_file(name, content)
+            fs.flush()
+
+            spool.seek(0)
+            buff = spool.read(self._bsize)
+            while buff:
+                yield buff
+                buff = spool.read(self._bsize)
+
+        buff = self._source.read(self._bsize)
+        while buff:
+            yield buff
+            buff = self._source.read(self._bsize)
+
 ###################
 ## Transfer class
 
@@ -620,6 +1232,698 @@ class Transfer(Output):
             self.src.close()
             self.dst.close()
 
+###################
+## Prefetch class
+
+class Prefetcher(object):
+    """fill the cache with downloaded, extracted and hashed images ahead of installs"""
+    def __init__(self, os_list_url, allow=(), bandwidth=0, windows=(), peers=(), quiet=True):
+        self.os_list_url = os_list_url
+        self.peers = peers
+        self.allow = [pattern.lower() for pattern in allow]
+        self.bucket = TokenBucket(bandwidth)
+        self.windows = TimeWindows(windows)
+        self._window_names = list(windows)
+        self.quiet = quiet
+
+    def is_allowed(self, entry):
+        name = entry.get('name', '').lower()
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.allow)
+
+    def allowed(self, os_list):
+        for entry in flatten_oslist(os_list):
+            if 'url' in entry and self.is_allowed(entry):
+                yield entry
+
+    def unverifiable(self, os_list):
+        """allowed entries without extract_sha256, a cached copy of those cannot be trusted"""
+        return [entry for entry in self.allowed(os_list) if not entry.get('extract_sha256')]
+
+    def pending(self, os_list):
+        for entry in self.allowed(os_list):
+            if not entry.get('extract_sha256'):
+                continue
+            image_filepath = cache_paths(entry)[1]
+            image_file = FileIo(image_filepath, 'rb', withHash=True)
+            if not cache_hit(image_file, entry.get('extract_sha256')):
+                yield entry
+
+    def fetch(self, entry):
+        download_filepath, image_filepath = cache_paths(entry)
+        image_sha = entry.get('extract_sha256')
+        if self.peers and image_sha:
+            try:
+                download_verified(
+                    FileIo(image_filepath, 'wb', withHash=True),
+                    image_sha,
+                    peers=self.peers,
+                    quiet=self.quiet,
+                    bucket=self.bucket,
+                    windows=self.windows
+                )
+                return
+            except Exception: # pylint: disable=broad-except
+                pass
+
+        download_file = FileIo(download_filepath, 'wb', withHash=True)
+        download_sha = entry.get('image_download_sha256')
+        if not cache_hit(download_file, download_sha):
+            download_verified(
+                download_file,
+                download_sha,
+                entry['url'],
+                self.peers,
+                quiet=self.quiet,
+                bucket=self.bucket,
+                windows=self.windows
+            )
+
+        extract_img(
+            download_filepath,
+            image_filepath,
+            total_size=entry.get('extract_size'),
+            quiet=self.quiet
+        )
+        verify_hash(FileIo(image_filepath, 'rb', withHash=True), image_sha)
+
+    def run(self, interval=0):
+        while True:
+            if not self.windows.is_open():
+                print(STR_PREFETCH_WAITING.format(', '.join(self._window_names)))
+                self.windows.wait()
+
+            os_list = build_oslist(self.os_list_url)
+            for entry in self.unverifiable(os_list):
+                print(" ✘ {0}".format(STR_PREFETCH_UNVERIFIABLE.format(entry['name'])))
+            pending = list(self.pending(os_list))
+            print(STR_PREFETCH_PENDING.format(len(pending)))
+            for entry in pending:
+                print(" - {0}".format(STR_PREFETCHING.format(entry['name'])))
+                try:
+                    self.fetch(entry)
+                except Exception as e: # pylint: disable=broad-except
+                    print(" ✘ {0}".format(STR_PREFETCH_FAILED.format(entry['name'], e)))
+                    continue
+                print(" ✔ {0}".format(STR_PREFETCHED.format(entry['name'])))
+
+            if not interval:
+                return
+            time.sleep(interval)
+
+###################
+## Peer cache classes
+
+class PeerCacheHandler(BaseHTTPRequestHandler):
+    """serve cached files by sha256 with range requests and sendfile"""
+    server_version = 'imagine-pi/' + __version__
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_GET(self):
+        self._serve()
+
+    def _serve(self, head=False):
+        match = re.match(r"^/sha256/([0-9a-f]{64})$", self.path)
+        path = self.server.lookup(match[1]) if match else None
+        if not path:
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                byte_range = parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            start, end = byte_range or (0, size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if byte_range:
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size))
+            self.end_headers()
+
+            if not head and end >= start:
+                self.wfile.flush()
+                self.connection.sendfile(f, start, end - start + 1)
+
+class PeerCacheServer(ThreadingHTTPServer):
+    """http server exposing files with a valid hashfile in the cache directories"""
+    daemon_threads = True
+
+    def __init__(self, address, cache_dirs):
+        super().__init__(address, PeerCacheHandler)
+        self.cache_dirs = cache_dirs
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, sha256):
+        with self._lock:
+            # recheck on every request, a cached path may be rewritten in place
+            if self._current_sha(self._index.get(sha256)) != sha256:
+                self._index = self.scan()
+            return self._index.get(sha256)
+
+    def scan(self):
+        index = {}
+        for directory in self.cache_dirs:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.startswith('.'):
+                    continue
+                sha256 = self._current_sha(path)
+                if sha256:
+                    index[sha256] = path
+        return index
+
+    def _current_sha(self, path):
+        """sha256 from the hashfile of path, None unless it still matches the file"""
+        if not path or not os.path.isfile(path):
+            return None
+        hash_file = HashFile(path)
+        try:
+            if not hash_file._sha_file_valid():
+                return None
+            # files still being written no longer match their hashfile mtime
+            data = hash_file._get_sha_data_raw()
+            if data['mtime'] != os.path.getmtime(path):
+                return None
+        except OSError:
+            return None
+        return data['sha256']
+
+class PeerAnnouncer(threading.Thread):
+    """answer multicast discovery queries with the port the cache is served on"""
+    def __init__(self, http_port, group=PEER_MULTICAST_GROUP):
+        super().__init__(daemon=True)
+        self.http_port = http_port
+        self.group = group
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.group[1]))
+        mreq = struct.pack('4sl', socket.inet_aton(self.group[0]), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        reply = '{0} {1}'.format(PEER_DISCOVERY_REPLY, self.http_port).encode('utf-8')
+        while True:
+            data, address = sock.recvfrom(1024)
+            if data == PEER_DISCOVERY_QUERY:
+                sock.sendto(reply, address)
+
+def discover_peers(timeout=1, group=PEER_MULTICAST_GROUP):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    peers = []
+    try:
+        sock.sendto(PEER_DISCOVERY_QUERY, group)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            sock.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                data, address = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            match = re.match(r"^{0} (\d+)$".format(PEER_DISCOVERY_REPLY), data.decode('utf-8', 'replace'))
+            if match:
+                peer = '{0}:{1}'.format(address[0], match[1])
+                if peer not in peers:
+                    peers.append(peer)
+    finally:
+        sock.close()
+    return peers
+
+def serve_cache(port=PEER_PORT, announce=True):
+    server = PeerCacheServer(('', port), [CACHE_DOWNLOAD_PATH, CACHE_IMAGE_PATH])
+    if announce:
+        PeerAnnouncer(server.server_address[1]).start()
+    print(STR_SERVING.format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+###################
+## Catalog index class
+
+class CatalogIndex(object):
+    """in memory token index over the installable entries of the os list"""
+    def __init__(self, os_list, subitems_property='subitems'):
+        self.entries = []
+        self.paths = []
+        self._postings = {}
+        self._walk(os_list, (), subitems_property)
+        self._tokens = sorted(self._postings)
+
+    def _walk(self, os_list, parents, subitems_property):
+        # an explicit stack keeps deep catalogs from hitting the recursion limit
+        stack = [(item, parents) for item in reversed(os_list)]
+        while stack:
+            item, parents = stack.pop()
+            if subitems_property in item:
+                stack += [
+                    (sub, parents + (item.get('name', ''),))
+                    for sub in reversed(item[subitems_property])
+                ]
+            elif 'url' in item:
+                self._add(item, parents)
+
+    def _add(self, entry, parents):
+        entry_id = len(self.entries)
+        self.entries.append(entry)
+        self.paths.append(' > '.join(parents))
+        fields = {
+            'name': [entry.get('name', '')],
+            'description': [entry.get('description', '')],
+            'release_date': [entry.get('release_date', '')],
+            'devices': entry.get('devices', []),
+            'sha': [entry.get('extract_sha256', ''), entry.get('image_download_sha256', '')],
+        }
+        for field, values in fields.items():
+            for value in values:
+                for token in search_tokens(value):
+                    postings = self._postings.setdefault(token, {})
+                    postings[entry_id] = max(postings.get(entry_id, 0), SEARCH_WEIGHTS[field])
+
+    def _matching_tokens(self, term):
+        start = bisect.bisect_left(self._tokens, term)
+        tokens = list(itertools.takewhile(
+            lambda token: token.startswith(term),
+            self._tokens[start:]
+        ))
+        if tokens:
+            return tokens, 1.0
+        return difflib.get_close_matches(term, self._tokens, 5, SEARCH_FUZZY_CUTOFF), 0.5
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        """return (entry, path) pairs matching every term of query by prefix or fuzzily, best first"""
+        scores = None
+        for term in query.lower().split():
+            tokens, factor = self._matching_tokens(term)
+            term_scores = {}
+            for token in tokens:
+                exact = 1.5 if token == term else 1.0
+                for entry_id, weight in self._postings[token].items():
+                    score = weight * exact * factor
+                    term_scores[entry_id] = max(term_scores.get(entry_id, 0), score)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict(
+                    (entry_id, score + term_scores[entry_id])
+                    for entry_id, score in scores.items() if entry_id in term_scores
+                )
+        if not scores:
+            return []
+
+        ranked = sorted(
+            scores,
+            key=lambda entry_id: (scores[entry_id], self.entries[entry_id].get('release_date', '')),
+            reverse=True
+        )
+        return [(self.entries[entry_id], self.paths[entry_id]) for entry_id in ranked[:limit]]
+
+###################
+## Batch classes
+
+class BatchJob(object):
+    """one image to device write in a batch"""
+    def __init__(self, image_path, image_name, disk):
+        self.image_path = image_path
+        self.image_name = image_name
+        self.disk = disk
+        self.bus = get_disk_bus(disk)
+        self.size = os.path.getsize(image_path)
+        self.written = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def running(self):
+        return self.started is not None and self.finished is None
+
+class SharedSource(threading.Thread):
+    """read an image once and hand every block to each job writing it"""
+    def __init__(self, source, jobs, bsize=BATCH_BLOCK_SIZE):
+        super().__init__(daemon=True)
+        self.source = source
+        self.jobs = jobs
+        self.bsize = bsize
+        self.queues = [queue.Queue(BATCH_QUEUE_BLOCKS) for _ in jobs]
+
+    def run(self):
+        try:
+            self.source.open()
+            buff = self.source.read(self.bsize)
+            while buff and self._put(buff):
+                buff = self.source.read(self.bsize)
+        except Exception as e: # pylint: disable=broad-except
+            for job in self.jobs:
+                job.error = job.error or e
+        finally:
+            self.source.close()
+            self._finish()
+
+    def _put(self, buff):
+        # the stream moves at the pace of its slowest live writer
+        alive = False
+        for job, blocks in zip(self.jobs, self.queues):
+            while job.error is None:
+                try:
+                    blocks.put(buff, timeout=1)
+                    alive = True
+                    break
+                except queue.Full:
+                    pass
+        return alive
+
+    def _finish(self):
+        # every writer gets the end marker, failed ones included, so each
+        # writer thread exits and marks its job finished
+        for job, blocks in zip(self.jobs, self.queues):
+            while True:
+                try:
+                    blocks.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    if job.error is not None:
+                        try:
+                            blocks.get_nowait()
+                        except queue.Empty:
+                            pass
+
+class DeviceWriter(threading.Thread):
+    """write blocks from a shared source to a device, syncing to measure real throughput"""
+    def __init__(self, job, blocks):
+        super().__init__(daemon=True)
+        self.job = job
+        self.blocks = blocks
+
+    def run(self):
+        unsynced = 0
+        try:
+            with open('/dev/{0}'.format(self.job.disk['name']), 'wb', buffering=0) as dev:
+                buff = self.blocks.get()
+                while buff is not None and self.job.error is None:
+                    # unbuffered writes may be short, keep going until the block is out
+                    view = memoryview(buff)
+                    while view:
+                        written = dev.write(view)
+                        if not written:
+                            raise OSError('no space left on {0}'.format(self.job.disk['name']))
+                        view = view[written:]
+                        unsynced += written
+                        self.job.written += written
+                    if unsynced >= BATCH_SYNC_BYTES:
+                        os.fsync(dev.fileno())
+                        unsynced = 0
+                    buff = self.blocks.get()
+                os.fsync(dev.fileno())
+        except Exception as e: # pylint: disable=broad-except
+            self.job.error = e
+        finally:
+            self.job.finished = time.time()
+
+class BusGroup(object):
+    """jobs sharing a bus and the concurrency that bus is allowed"""
+    def __init__(self, name):
+        self.name = name
+        self.limit = 1
+        self.frozen = False
+        self.throughput = {}
+        self.rate = 0
+        self._samples = []
+        self._concurrency = 0
+
+    def sample(self, running, rate):
+        self.rate = rate
+        if running != self._concurrency:
+            self._concurrency = running
+            self._samples = []
+            return
+        self._samples.append(rate)
+        if running != self.limit or len(self._samples) < BATCH_SETTLE_SAMPLES:
+            return
+
+        rate = sum(self._samples) / len(self._samples)
+        self._samples = []
+        self.throughput[running] = max(rate, self.throughput.get(running, 0))
+        previous = self.throughput.get(running - 1)
+        if previous and rate < previous:
+            self.limit -= 1
+            self.frozen = True
+        elif not self.frozen and self.limit < BATCH_MAX_PER_BUS:
+            if previous is None or rate >= previous * (1 + BATCH_MIN_GAIN):
+                self.limit += 1
+            else:
+                self.frozen = True
+
+class BatchScheduler(Output):
+    """write many images to many devices, adapting concurrency per bus"""
+    def __init__(self, jobs, boot_files=None, quiet=False):
+        Output.__init__(self)
+        self.jobs = jobs
+        self.boot_files = boot_files or {}
+        self.quiet = quiet
+        self.buses = {}
+        for job in jobs:
+            self.buses.setdefault(job.bus, BusGroup(job.bus))
+
+    def pending(self):
+        return [job for job in self.jobs if job.started is None and job.error is None]
+
+    def running(self, bus=None):
+        return [job for job in self.jobs if job.running and (bus is None or job.bus == bus)]
+
+    def _has_capacity(self, bus, starting=()):
+        running = len(self.running(bus)) + len([j for j in starting if j.bus == bus])
+        return running < self.buses[bus].limit
+
+    def _start_ready(self):
+        for job in self.pending():
+            if job.started is not None or not self._has_capacity(job.bus):
+                continue
+            group = [job]
+            for other in self.pending():
+                if (other is not job and other.image_path == job.image_path
+                        and self._has_capacity(other.bus, group)):
+                    group.append(other)
+
+            source = FileIo(job.image_path, 'rb')
+            if self.boot_files:
+                source = BootCustomizeIo(source, self.boot_files, BATCH_BLOCK_SIZE)
+            shared = SharedSource(source, group)
+            for member, blocks in zip(group, shared.queues):
+                member.started = time.time()
+                DeviceWriter(member, blocks).start()
+            shared.start()
+
+    def start(self):
+        st = time.time()
+        last = dict((id(job), 0) for job in self.jobs)
+        try:
+            self._start_ready()
+            while self.pending() or self.running():
+                time.sleep(BATCH_SAMPLE_INTERVAL)
+                rates = {}
+                for job in self.jobs:
+                    rates[id(job)] = (job.written - last[id(job)]) / BATCH_SAMPLE_INTERVAL
+                    last[id(job)] = job.written
+                for name, bus in self.buses.items():
+                    jobs = self.running(name)
+                    bus.sample(len(jobs), sum(rates[id(job)] for job in jobs))
+                prefix = ' '.join(
+                    '{0} {1}/s'.format(job.disk['name'], self.size(rates[id(job)]).strip())
+                    for job in self.running()
+                )
+                self._start_ready()
+
+                total = sum(job.size for job in self.jobs)
+                written = sum(job.written for job in self.jobs)
+                if written:
+                    self.display(total, written, written, st, prefix + ' ')
+            self.clear_display()
+        except KeyboardInterrupt:
+            for job in self.jobs:
+                job.error = job.error or KeyboardInterrupt()
+            sys.exit(1)
+
+        for job in self.jobs:
+            if job.error is not None:
+                print(" ✘ {0}".format(STR_BATCH_FAILED.format(
+                    job.image_name, job.disk['name'], job.error
+                )))
+        written = sum(job.written for job in self.jobs)
+        elapsed = time.time() - st
+        print(" ✔ {0}".format(STR_BATCH_DONE.format(
+            len([job for job in self.jobs if job.error is None]),
+            len([job for job in self.jobs if job.error is not None]),
+            self.time(elapsed).strip(),
+            self.size(written / elapsed).strip()
+        )))
+
+###################
+## Probe class
+
+class DeviceProbe(HumanReadable):
+    """check a device for fake capacity and profile its write performance per region"""
+    def __init__(self, path, size):
+        self.path = path
+        self.capacity = size - size % PROBE_BLOCK_SIZE
+        self.fd = None
+        self.direct = False
+        self._saved = []
+
+    def open(self):
+        flags = os.O_RDWR | os.O_SYNC
+        try:
+            self.fd = os.open(self.path, flags | getattr(os, 'O_DIRECT', 0))
+            self.direct = hasattr(os, 'O_DIRECT')
+        except OSError:
+            self.fd = os.open(self.path, flags)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _pread(self, size, offset):
+        if not self.direct:
+            os.posix_fadvise(self.fd, offset, size, os.POSIX_FADV_DONTNEED)
+        # mmap buffers are page aligned as O_DIRECT requires
+        buff = mmap.mmap(-1, size)
+        os.preadv(self.fd, [buff], offset)
+        return bytes(buff)
+
+    def _pwrite(self, data, offset):
+        buff = mmap.mmap(-1, len(data))
+        buff.write(data)
+        os.pwrite(self.fd, buff, offset)
+
+    def _save(self, size, offset):
+        """keep the original content of a range to restore afterwards"""
+        self._saved.append((offset, self._pread(size, offset)))
+
+    def _scratch(self, data, offset):
+        self._save(len(data), offset)
+        self._pwrite(data, offset)
+
+    def _holds(self, data, offset):
+        """whether offset reads back as data, unreadable blocks do not"""
+        try:
+            return self._pread(len(data), offset) == data
+        except OSError:
+            return False
+
+    def restore(self):
+        """best effort, a failing block must not hide the probe result"""
+        while self._saved:
+            offset, data = self._saved.pop()
+            try:
+                self._pwrite(data, offset)
+            except OSError:
+                pass
+        try:
+            os.fsync(self.fd)
+        except OSError:
+            pass
+
+    def check_capacity(self):
+        """return the sampled offsets that did not keep their data and the sample count"""
+        # every offset must stay block aligned for O_DIRECT
+        step = self.capacity // PROBE_SAMPLES
+        step = max(step - step % PROBE_BLOCK_SIZE, PROBE_BLOCK_SIZE)
+        offsets = sorted(set(
+            [min(i * step, self.capacity - PROBE_BLOCK_SIZE) for i in range(PROBE_SAMPLES)]
+            + [self.capacity - PROBE_BLOCK_SIZE]
+        ))
+        nonce = os.urandom(16)
+        expected = {}
+        for offset in offsets:
+            header = b'IMAGINE-PI' + struct.pack('<Q', offset) + nonce
+            expected[offset] = header + os.urandom(PROBE_BLOCK_SIZE - len(header))
+            try:
+                self._scratch(expected[offset], offset)
+            except OSError:
+                # an i/o error at a sample is as lost as a wrapped block
+                pass
+        try:
+            os.fsync(self.fd)
+        except OSError:
+            return offsets, len(offsets)
+
+        # cards faking their size wrap writes onto lower blocks, so only
+        # read back once every sample has been written
+        lost = [offset for offset in offsets if not self._holds(expected[offset], offset)]
+        return lost, len(offsets)
+
+    def profile(self, regions=PROBE_REGIONS):
+        """measure sequential throughput and random write latency in each region"""
+        region_size = self.capacity // regions
+        results = []
+        for i in range(regions):
+            start = i * region_size - (i * region_size) % PROBE_BLOCK_SIZE
+            seq_bytes = min(PROBE_SEQ_BYTES, region_size - region_size % PROBE_BLOCK_SIZE)
+            block = os.urandom(min(PROBE_SEQ_BLOCK, seq_bytes))
+
+            # originals are saved before timing so only writes are measured
+            self._save(seq_bytes, start)
+            st = time.monotonic()
+            for offset in range(start, start + seq_bytes, len(block)):
+                self._pwrite(block[:start + seq_bytes - offset], offset)
+            os.fsync(self.fd)
+            sequential = seq_bytes / max(time.monotonic() - st, 1e-6)
+
+            blocks = max(region_size // PROBE_BLOCK_SIZE, 1)
+            offsets = [
+                start + random.randrange(blocks) * PROBE_BLOCK_SIZE
+                for _ in range(PROBE_RANDOM_WRITES)
+            ]
+            for offset in offsets:
+                self._save(PROBE_BLOCK_SIZE, offset)
+            data = os.urandom(PROBE_BLOCK_SIZE)
+            latencies = []
+            for offset in offsets:
+                st = time.monotonic()
+                self._pwrite(data, offset)
+                os.fsync(self.fd)
+                latencies.append(time.monotonic() - st)
+
+            results.append(ProbeRegion(start, region_size, sequential, sum(latencies) / len(latencies)))
+        return results
+
+    def estimate(self, regions, image_size):
+        """seconds to write image_size bytes from the start of the device"""
+        seconds = 0
+        for region in regions:
+            covered = min(max(image_size - region.offset, 0), region.size)
+            seconds += covered / region.sequential
+        return seconds
+
+    def heatmap(self, regions, width=40):
+        fastest = max(region.sequential for region in regions)
+        lines = []
+        for region in regions:
+            bar = int(width * region.sequential / fastest)
+            lines.append('{0:>10} {1}{2} {3:>12}/s {4:7.1f} ms'.format(
+                self.size(region.offset).strip(),
+                '█' * bar,
+                '░' * (width - bar),
+                self.size(region.sequential).strip(),
+                region.latency * 1000
+            ))
+        return '\n'.join(lines)
+
 ###################
 ## helpers
 
@@ -639,6 +1943,379 @@ def build_oslist(os_list_url):
             os['subitems'] = build_oslist(os['subitems_url'])
     return os_list
 
+def flatten_oslist(os_list, subitems_property='subitems'):
+    for item in os_list:
+        if subitems_property in item:
+            yield from flatten_oslist(item[subitems_property], subitems_property)
+        else:
+            yield item
+
+def cache_paths(os_entry):
+    """return the cached download and image paths for an os list entry"""
+    download_filename = os.path.basename(os_entry['url'])
+    download_ext = os.path.splitext(download_filename)
+    download_basename = download_ext[0]
+    if download_ext[0].endswith('img'):
+        download_basename = os.path.splitext(download_ext[0])[0]
+    image_filename = download_basename + ".img"
+    return (
+        os.path.join(CACHE_DOWNLOAD_PATH, download_filename),
+        os.path.join(CACHE_IMAGE_PATH, image_filename)
+    )
+
+def cache_hit(file_io, sha256):
+    if not sha256 or not file_io.is_existing_file():
+        return False
+    return sha256 == file_io.hashFile.getHash()
+
+def verify_hash(file_io, sha256):
+    if sha256 and sha256 != file_io.hashFile.getHash():
+        raise ValueError('sha256 mismatch for {0}'.format(file_io._target_path))
+
+def mirror_urls(url):
+    """return url followed by the same path on every configured mirror"""
+    path = urlparse(url).path
+    return [url] + [mirror.rstrip('/') + path for mirror in MIRRORS]
+
+def probe_mirrors(urls):
+    """rank urls (or the targets they redirect to) by the throughput of a short ranged read"""
+    if len(urls) < 2:
+        return list(urls)
+
+    results = {}
+    def probe(url):
+        st = time.monotonic()
+        try:
+            with requests.get(
+                    url,
+                    stream=True,
+                    headers={'Range': 'bytes=0-{0}'.format(MIRROR_PROBE_BYTES - 1)},
+                    timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+            ) as response:
+                if response.status_code not in (200, 206):
+                    return
+                size = len(response.raw.read(MIRROR_PROBE_BYTES))
+                results[response.url] = size / max(time.monotonic() - st, 0.001)
+        except (OSError, requests.RequestException, requests.packages.urllib3.exceptions.HTTPError):
+            pass
+
+    probes = [threading.Thread(target=probe, args=(url,), daemon=True) for url in urls]
+    for thread in probes:
+        thread.start()
+    for thread in probes:
+        thread.join(HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT)
+
+    return sorted(results, key=results.get, reverse=True) or list(urls)
+
+def download_verified(file_io, sha256, url=None, peers=(), quiet=False, bucket=None, windows=None):
+    """download from peers or url into file_io and verify against sha256"""
+    source = HttpIo(url, sha256, peers)
+    try:
+        Transfer(ThrottledIo(source, bucket, windows), file_io, quiet=quiet, prefix='').start()
+        verify_hash(file_io, sha256)
+    except Exception: # pylint: disable=broad-except
+        if not (source.peer and url):
+            raise
+        # a peer failed or served bad data, retry from upstream only
+        download_verified(file_io, sha256, url, (), quiet, bucket, windows)
+
+def parse_range(header, size):
+    """parse a single 'bytes=' range header, None when it should be ignored"""
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (header or '').strip())
+    if not match or not (match[1] or match[2]):
+        return None
+    if match[1]:
+        start = int(match[1])
+        end = min(int(match[2]), size - 1) if match[2] else size - 1
+    else:
+        start = max(size - int(match[2]), 0)
+        end = size - 1
+    if start > end:
+        raise ValueError('unsatisfiable range: {0}'.format(header))
+    return (start, end)
+
+def boot_customizations(hostname=None, ssh=False, wifi_ssid=None, wifi_password=None,
+                        wifi_country=WIFI_COUNTRY, firstrun=None, boot_files=()):
+    """build the boot partition files to add, values may patch existing content"""
+    files = {}
+    for path in boot_files:
+        with open(path, 'rb') as f:
+            files[os.path.basename(path)] = f.read()
+
+    if ssh:
+        files['ssh'] = b''
+
+    script = []
+    cmdline_params = FIRSTRUN_CMDLINE.format(FIRSTRUN_PATH)
+    if hostname:
+        script.append(FIRSTRUN_HOSTNAME.format(hostname))
+
+    if wifi_ssid:
+        # ssids are written as hex or byte lists so no quoting can break them
+        ssid = wifi_ssid.encode('utf-8')
+        if wifi_password:
+            psk = hashlib.pbkdf2_hmac('sha1', wifi_password.encode('utf-8'), ssid, 4096, 32)
+            network = 'psk={0}'.format(psk.hex())
+            security = NM_WIFI_SECURITY.format(psk.hex())
+        else:
+            network = 'key_mgmt=NONE'
+            security = ''
+        wpa_supplicant = WPA_SUPPLICANT_TEMPLATE.format(wifi_country, ssid.hex(), network)
+        nm_connection = NM_CONNECTION_TEMPLATE.format(
+            uuid.uuid4(),
+            ''.join('{0};'.format(c) for c in ssid),
+            security
+        )
+        # older releases pick this up from the boot partition, releases
+        # using NetworkManager only get wifi from the firstrun script
+        files['wpa_supplicant.conf'] = wpa_supplicant.encode('utf-8')
+        script.append(FIRSTRUN_WIFI.format(nm_connection, wpa_supplicant))
+        cmdline_params = ' cfg80211.ieee80211_regdom={0}'.format(wifi_country) + cmdline_params
+
+    if firstrun:
+        with open(firstrun, 'r') as f:
+            script.append(f.read())
+    if script:
+        files[os.path.basename(FIRSTRUN_PATH)] = FIRSTRUN_TEMPLATE.format(
+            '\n'.join(script)
+        ).encode('utf-8')
+        files['cmdline.txt'] = lambda cmdline: append_cmdline(cmdline, cmdline_params)
+
+    return files
+
+def append_cmdline(cmdline, params):
+    return cmdline.rstrip(b'\r\n') + params.encode('utf-8') + b'\n'
+
+def parse_country(value):
+    if not re.match(r"^[A-Za-z]{2}$", value):
+        raise argparse.ArgumentTypeError('invalid country code: {0}'.format(value))
+    return value.upper()
+
+def parse_hostname(value):
+    if not re.match(r"^[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?$", value):
+        raise argparse.ArgumentTypeError('invalid hostname: {0}'.format(value))
+    return value
+
+def find_boot_partition(mbr):
+    """return byte offset and length of the first FAT partition in an MBR"""
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b'\x55\xaa':
+        raise ValueError('image has no MBR partition table')
+    for i in range(4):
+        entry = mbr[446 + i * 16:462 + i * 16]
+        start, sectors = struct.unpack_from('<II', entry, 8)
+        if entry[4] == 0xEE:
+            raise ValueError('GPT partitioned images are not supported')
+        if entry[4] in FAT_PARTITION_TYPES and sectors:
+            return start * SECTOR_SIZE, sectors * SECTOR_SIZE
+    raise ValueError('image has no FAT boot partition')
+
+def fat_short_name(name, existing=()):
+    """return the 8.3 directory name for name and whether it is exact or a ~N alias"""
+    invalid = r"[^A-Z0-9_!#$%&'()@^`{}~-]"
+    base, ext = os.path.splitext(name.upper())
+    ext = ext[1:]
+    clean_base = re.sub(invalid, '', base)
+    clean_ext = re.sub(invalid, '', ext)
+    if (name == name.upper() and clean_base == base and clean_ext == ext
+            and 0 < len(base) <= 8 and len(ext) <= 3):
+        return (base.ljust(8) + ext.ljust(3)).encode('ascii'), True
+    for n in itertools.count(1):
+        tail = '~{0}'.format(n)
+        short = (clean_base[:8 - len(tail)] + tail).ljust(8) + clean_ext[:3].ljust(3)
+        if short.encode('ascii') not in existing:
+            return short.encode('ascii'), False
+
+def fat_checksum(short_name):
+    checksum = 0
+    for c in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    return checksum
+
+def dos_datetime(timestamp=None):
+    t = time.localtime(timestamp)
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return date, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+def retrieve_image(selected_os, peers=()):
+    """make sure the image for an os list entry is in the cache and return its path"""
+    download_url = selected_os['url']
+    download_filepath, image_filepath = cache_paths(selected_os)
+
+    print(" - {0}".format(STR_RETRIEVING.format(STR_IMG)))
+    print("    - {0}".format(STR_CHECKING_CACHE))
+
+    download_file = FileIo(download_filepath, 'wb', withHash=True)
+    image_file = FileIo(image_filepath, 'rb', withHash=True)
+
+    image_cached = False
+    if 'extract_sha256' in selected_os and image_file.is_existing_file():
+        os_image_sha = selected_os["extract_sha256"]
+        if os_image_sha == image_file.hashFile.getHash():
+            image_cached = True
+
+    image_peer_cached = False
+    if not image_cached and peers and 'extract_sha256' in selected_os:
+        print("    - {0}".format(STR_RETRIEVING.format(STR_IMG + ' from ' + STR_PEERS)))
+        try:
+            download_verified(
+                FileIo(image_filepath, 'wb', withHash=True),
+                selected_os['extract_sha256'],
+                peers=peers
+            )
+            image_peer_cached = True
+        except Exception: # pylint: disable=broad-except
+            pass
+
+    if image_cached:
+        print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_CACHE)))
+        print(" ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_CACHE)))
+    elif image_peer_cached:
+        print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_PEERS)))
+        print(" ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_PEERS)))
+    else:
+        print("    - {0}".format(STR_RETRIEVING.format(STR_IMG_ARCHIVE)))
+
+        download_cached = False
+        if 'image_download_sha256' in selected_os and download_file.is_existing_file():
+            print("       - {0}".format(STR_CHECKING_CACHE))
+            download_image_sha = selected_os["image_download_sha256"]
+            if  download_image_sha == download_file.hashFile.getHash():
+                download_cached = True
+        if download_cached:
+            print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG_ARCHIVE, STR_CACHE)))
+        else:
+            print("      {0}".format(STR_DOWNLOADING.format(STR_IMG_ARCHIVE)))
+            download_verified(
+                download_file,
+                selected_os.get('image_download_sha256'),
+                download_url,
+                peers
+            )
+            print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG_ARCHIVE, STR_DOWNLOAD)))
+
+        print("    - {0}".format(STR_EXTRACTING.format(STR_IMG, STR_IMG_ARCHIVE)))
+
+        extract_img(download_filepath, image_filepath, total_size=selected_os["extract_size"])
+        print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_IMG_ARCHIVE)))
+        print(" ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_IMG_ARCHIVE)))
+
+    return image_filepath
+
+def parse_size(value):
+    """parse sizes like 512K, 2M or 1.5G into bytes"""
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?$", value.strip(), re.I)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: {0}'.format(value))
+    return int(float(match[1]) * 1024 ** ' KMGT'.index(match[2].upper() or ' '))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='imagine_pi', description=STR_TITLE_SUB)
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument(
+        '--prefetch', action='store_true',
+        help='download, extract and hash allowed images into the cache and exit'
+    )
+    parser.add_argument(
+        '--allow', action='append', metavar='PATTERN',
+        help='os name pattern to prefetch, may be repeated (e.g. "*Lite*")'
+    )
+    parser.add_argument(
+        '--limit', type=parse_size, default=PREFETCH_BANDWIDTH, metavar='RATE',
+        help='prefetch bandwidth per second, accepts K/M/G suffixes'
+    )
+    parser.add_argument(
+        '--window', action='append', metavar='HH:MM-HH:MM',
+        help='time window in which prefetch may download, may be repeated'
+    )
+    parser.add_argument(
+        '--interval', type=int, default=0, metavar='SECONDS',
+        help='keep running and prefetch again every SECONDS'
+    )
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='serve the local cache to peers over http and exit on interrupt'
+    )
+    parser.add_argument(
+        '--port', type=int, default=PEER_PORT,
+        help='port to serve the cache on'
+    )
+    parser.add_argument(
+        '--peer', action='append', metavar='HOST:PORT',
+        help='peer to fetch cached files from before upstream, may be repeated'
+    )
+    parser.add_argument(
+        '--discover', action='store_true',
+        help='discover peers serving their cache on the local network'
+    )
+    parser.add_argument(
+        '--cache', metavar='PATH',
+        help='cache directory (default {0})'.format(CACHE_PATH)
+    )
+    parser.add_argument(
+        '--hostname', type=parse_hostname,
+        help='hostname set by the firstrun script'
+    )
+    parser.add_argument(
+        '--ssh', action='store_true',
+        help='enable ssh on first boot'
+    )
+    parser.add_argument('--wifi-ssid', metavar='SSID', help='wifi network to join')
+    parser.add_argument('--wifi-password', metavar='PASSWORD', help='wifi passphrase')
+    parser.add_argument(
+        '--wifi-country', type=parse_country, metavar='CC', default=WIFI_COUNTRY,
+        help='wifi regulatory country (default {0})'.format(WIFI_COUNTRY)
+    )
+    parser.add_argument(
+        '--firstrun', metavar='SCRIPT',
+        help='shell script run once on first boot'
+    )
+    parser.add_argument(
+        '--boot-file', action='append', metavar='PATH',
+        help='file to add to the boot partition, may be repeated'
+    )
+    parser.add_argument(
+        '--mirror', action='append', metavar='URL',
+        help='mirror base url serving the upstream paths, may be repeated'
+    )
+    parser.add_argument(
+        '--connect-timeout', type=float, default=HTTP_CONNECT_TIMEOUT, metavar='SECONDS',
+        help='http connect timeout (default {0})'.format(HTTP_CONNECT_TIMEOUT)
+    )
+    parser.add_argument(
+        '--read-timeout', type=float, default=HTTP_READ_TIMEOUT, metavar='SECONDS',
+        help='http read timeout (default {0})'.format(HTTP_READ_TIMEOUT)
+    )
+    parser.add_argument(
+        '--stall-rate', type=parse_size, default=MIRROR_STALL_RATE, metavar='RATE',
+        help='per second throughput below which a mirror counts as stalled'
+    )
+    parser.add_argument(
+        '--stall-seconds', type=int, default=MIRROR_STALL_SECONDS, metavar='SECONDS',
+        help='seconds a mirror may stall before switching to another'
+    )
+    parser.add_argument(
+        '--probe', action='store_true',
+        help='check devices for fake capacity and profile write speed before writing'
+    )
+    parser.add_argument(
+        '--min-throughput', type=parse_size, default=PROBE_MIN_THROUGHPUT, metavar='RATE',
+        help='reject devices whose probed write speed per second is below RATE'
+    )
+    parser.add_argument(
+        '--search', metavar='QUERY',
+        help='list os images matching QUERY and exit'
+    )
+    parser.add_argument(
+        '--os', metavar='QUERY',
+        help='pick the os from a single menu of images matching QUERY'
+    )
+    parser.add_argument(
+        '--batch', metavar='FILE',
+        help="write many images from a file of 'device image' lines, "
+             "image is an os name or a local .img path"
+    )
+    return parser.parse_args(argv)
+
 def get_disk_info(disk_name=None):
     cmd = ['lsblk', '-JOb']
     discs_info_json = str(subprocess.check_output(cmd).decode('utf-8'))
@@ -652,6 +2329,89 @@ def get_disk_info(disk_name=None):
 
     raise FileNotFoundError(disk_name)
 
+def get_disk_bus(disk):
+    """return the sysfs path of the hub or host a disk shares bandwidth on"""
+    sysfs = os.path.realpath('/sys/block/{0}'.format(disk['name']))
+    parts = sysfs.split('/')
+    usb_ports = [i for i, part in enumerate(parts) if re.match(r"^\d+-\d+(\.\d+)*$", part)]
+    if disk.get('tran') == 'usb' and usb_ports:
+        # the parent of the first port is the root hub, of the last port the hub in use
+        return '/'.join(parts[:usb_ports[-1]])
+    if disk.get('hctl'):
+        return '{0}:host{1}'.format(disk.get('tran') or 'scsi', disk['hctl'].split(':')[0])
+    if os.path.exists(sysfs) and 'block' in parts:
+        return '/'.join(parts[:parts.index('block') - 1])
+    return disk['name']
+
+def probe_disk(disk, image_size=None, min_throughput=PROBE_MIN_THROUGHPUT):
+    """probe a disk before writing to it, print the results and return if it is usable"""
+    print(" - {0}".format(STR_PROBING.format(disk['name'])))
+    probe = DeviceProbe('/dev/{0}'.format(disk['name']), int(disk['size']))
+    try:
+        probe.open()
+        lost, samples = probe.check_capacity()
+        regions = None if lost else probe.profile()
+    except OSError as e:
+        print(" ✘ {0}".format(STR_PROBE_ERROR.format(disk['name'], e)))
+        return False
+    finally:
+        if probe.fd is not None:
+            probe.restore()
+            probe.close()
+
+    if lost:
+        print(" ✘ {0}".format(STR_PROBE_FAKE.format(disk['name'], len(lost), samples)))
+        return False
+
+    for line in probe.heatmap(regions).split('\n'):
+        print("    {0}".format(line))
+    image_size = image_size or probe.capacity
+    seconds = probe.estimate(regions, image_size)
+    print("    - {0}".format(STR_PROBE_ESTIMATE.format(
+        probe.size(image_size).strip(),
+        probe.time(seconds)
+    )))
+    if min_throughput and image_size / seconds < min_throughput:
+        print(" ✘ {0}".format(STR_PROBE_SLOW.format(
+            disk['name'],
+            probe.size(image_size / seconds).strip(),
+            probe.size(min_throughput).strip()
+        )))
+        return False
+
+    print(" ✔ {0}".format(STR_PROBE_PASSED.format(disk['name'])))
+    return True
+
+def search_tokens(value):
+    """whole words and their alphanumeric parts, lower cased"""
+    tokens = set()
+    for word in str(value).lower().split():
+        word = word.strip('()[]{},;:"\'')
+        if word:
+            tokens.add(word)
+            tokens.update(re.findall(r"[a-z0-9]+", word))
+    return tokens
+
+def find_os(os_list, name):
+    for entry in flatten_oslist(os_list):
+        if 'url' in entry and entry.get('name', '').lower() == name.lower():
+            return entry
+    raise LookupError(name)
+
+def parse_batch_file(path):
+    """read 'device image' lines, image is an os name or a local image path"""
+    jobs = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError(STR_BATCH_INVALID.format(number, line))
+            jobs.append((os.path.basename(fields[0]), fields[1]))
+    return jobs
+
 def disk_has_mounts(disk_name):
     disk_info = get_disk_info(disk_name)
     if disk_info['mountpoint']:
@@ -681,16 +2441,102 @@ def ensure_root():
 ## main
 
 
+args = parse_args()
+
+if args.cache:
+    CACHE_PATH = args.cache
+    CACHE_DOWNLOAD_PATH = CACHE_PATH + '/download'
+    CACHE_IMAGE_PATH = CACHE_PATH + '/images'
+
+MIRRORS = args.mirror or MIRRORS
+HTTP_CONNECT_TIMEOUT = args.connect_timeout
+HTTP_READ_TIMEOUT = args.read_timeout
+MIRROR_STALL_RATE = args.stall_rate
+MIRROR_STALL_SECONDS = args.stall_seconds
+
 ## init
-if ENV != 'dev':
+if ENV != 'dev' and not (args.serve or args.search):
     ensure_root()
 
 ensure_path_exists(CACHE_DOWNLOAD_PATH)
 ensure_path_exists(CACHE_IMAGE_PATH)
 
+if args.serve:
+    serve_cache(args.port)
+    sys.exit()
+
+peers = (args.peer or PEERS) + (discover_peers() if args.discover else [])
+boot_files = boot_customizations(
+    hostname=args.hostname,
+    ssh=args.ssh,
+    wifi_ssid=args.wifi_ssid,
+    wifi_password=args.wifi_password,
+    wifi_country=args.wifi_country,
+    firstrun=args.firstrun,
+    boot_files=args.boot_file or ()
+)
+
+if args.prefetch:
+    Prefetcher(
+        OS_LIST_URL,
+        allow=args.allow or PREFETCH_ALLOW,
+        bandwidth=args.limit,
+        windows=args.window or PREFETCH_WINDOWS,
+        peers=peers
+    ).run(args.interval)
+    sys.exit()
+
 ## get choices
 os_list = build_oslist(OS_LIST_URL)
 
+if args.search:
+    search_results = CatalogIndex(os_list).search(args.search)
+    print(STR_SEARCH_RESULTS.format(len(search_results), args.search))
+    for entry, path in search_results:
+        print(STR_SEARCH_RESULT.format(
+            entry['name'],
+            entry.get('release_date', '-'),
+            HumanReadable().size(entry.get('extract_size', 0)).strip(),
+            path
+        ))
+    sys.exit()
+
+if args.batch:
+    images = {}
+    batch_jobs = []
+    for device, image in parse_batch_file(args.batch):
+        if image not in images:
+            if file_exists(image):
+                images[image] = image
+            else:
+                images[image] = retrieve_image(find_os(os_list, image), peers)
+        if disk_has_mounts(device) or device in [job.disk['name'] for job in batch_jobs]:
+            sys.exit(STR_NO_AVAILABLE_STORAGE + ': ' + device)
+        batch_jobs.append(BatchJob(images[image], image, get_disk_info(device)))
+
+    batch_summary = '\n'.join(
+        STR_BATCH_JOB.format(job.image_name, job.disk['name'], job.bus) for job in batch_jobs
+    )
+    if ENV != 'dev' and not Whiptail(STR_TITLE, STR_BACKTITLE, WHIPTAIL_HEIGHT, WHIPTAIL_WIDTH).confirm(
+            STR_CONFIRM_BATCH.format(len(batch_jobs), batch_summary)):
+        sys.exit(STR_ABORT_INSTALL)
+
+    # probing writes to the devices, so only after they are confirmed
+    if args.probe:
+        batch_jobs = [
+            job for job in batch_jobs
+            if probe_disk(job.disk, job.size, args.min_throughput)
+        ]
+        if not batch_jobs:
+            sys.exit(STR_NO_AVAILABLE_STORAGE)
+        batch_summary = '\n'.join(
+            STR_BATCH_JOB.format(job.image_name, job.disk['name'], job.bus) for job in batch_jobs
+        )
+    print(batch_summary)
+    BatchScheduler(batch_jobs, boot_files).start()
+    os.sync()
+    sys.exit()
+
 WT = Whiptail(
     STR_TITLE,
     STR_BACKTITLE,
@@ -701,6 +2547,19 @@ WT = Whiptail(
 try:
     if ENV == 'dev':
         selected_os = os_list[1]['subitems'][0]
+    elif args.os:
+        os_matches = CatalogIndex(os_list).search(args.os)
+        if not os_matches:
+            WT.alert(STR_SEARCH_NO_RESULTS.format(args.os))
+            sys.exit()
+        if len(os_matches) == 1:
+            selected_os = os_matches[0][0]
+        else:
+            # an image listed in several categories only differs by its path
+            selected_os = WT.filtermenu(
+                STR_SELECT_OS,
+                [dict(entry, description=path) for entry, path in os_matches]
+            )
     else:
         selected_os = WT.submenu(STR_SELECT_OS, os_list)
 except:
@@ -757,62 +2616,22 @@ summary_str = STR_SUMMARY.format(
 
 print("{0}\n\n{1}\n\n".format(header_str, summary_str))
 
-download_url = selected_os['url']
-download_filename = os.path.basename(download_url)
-download_filepath = os.path.join(CACHE_DOWNLOAD_PATH, download_filename)
-download_ext = os.path.splitext(download_filename)
-download_compression = download_ext[1]
-download_basename = download_ext[0]
-if download_ext[0].endswith('img'):
-    download_basename = os.path.splitext(download_ext[0])[0]
-image_filename = download_basename + ".img"
-image_filepath = os.path.join(CACHE_IMAGE_PATH, image_filename)
-
-print(" - {0}".format(STR_RETRIEVING.format(STR_IMG)))
-print("    - {0}".format(STR_CHECKING_CACHE))
-
-img_source = HttpIo(download_url)
-download_file = FileIo(download_filepath, 'wb', withHash=True)
+if args.probe and not probe_disk(selected_disk, selected_os.get('extract_size'), args.min_throughput):
+    sys.exit(STR_ABORT_INSTALL)
+
+image_filepath = retrieve_image(selected_os, peers)
 image_file = FileIo(image_filepath, 'rb', withHash=True)
 drive_target = FileIo("/dev/{0}".format(selected_disk['name']), 'wb')
 
-
-image_cached = False
-if 'extract_sha256' in selected_os and image_file.is_existing_file():
-    os_image_sha = selected_os["extract_sha256"]
-    if os_image_sha == image_file.hashFile.getHash():
-        image_cached = True
-
-if image_cached:
-    print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_CACHE)))
-    print(" ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_CACHE)))
-else:
-    print("    - {0}".format(STR_RETRIEVING.format(STR_IMG_ARCHIVE)))
-
-    download_cached = False
-    if 'image_download_sha256' in selected_os and download_file.is_existing_file():
-        print("       - {0}".format(STR_CHECKING_CACHE))
-        download_image_sha = selected_os["image_download_sha256"]
-        if  download_image_sha == download_file.hashFile.getHash():
-            download_cached = True
-    if download_cached:
-        print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG_ARCHIVE, STR_CACHE)))
-    else:
-        print("      {0}".format(STR_DOWNLOADING.format(STR_IMG_ARCHIVE)))
-        Transfer(img_source, download_file, prefix='').start()
-        print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG_ARCHIVE, STR_DOWNLOAD)))
-
-    print("    - {0}".format(STR_EXTRACTING.format(STR_IMG, STR_IMG_ARCHIVE)))
-
-    extract_img(download_filepath, image_filepath, total_size=selected_os["extract_size"])
-    print("    ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_IMG_ARCHIVE)))
-    print(" ✔ {0}".format(STR_AVAILABLE.format(STR_IMG, STR_IMG_ARCHIVE)))
-
 print(" - {0}".format(STR_WRITING_IMG.format(
     selected_os['name'],
     selected_disk['name']
 )))
-Transfer(image_file, drive_target, prefix='').start()
+image_source = image_file
+if boot_files:
+    print("    - {0}".format(STR_CUSTOMIZING.format(', '.join(sorted(boot_files)))))
+    image_source = BootCustomizeIo(image_file, boot_files)
+Transfer(image_source, drive_target, prefix='').start()
 os.sync()
 print(" ✔ {0}".format(STR_IMG_INSTALLED.format(
     selected_os['name'],